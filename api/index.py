@@ -1,105 +1,143 @@
 from flask import Flask, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote_from_bytes
 import json
+import orjson
 import re
-import uuid
+import os
 import time
-from bs4 import BeautifulSoup
-from datetime import datetime
+import itertools
+import threading
 
 app = Flask(__name__)
 
-def extract_snlm0e_token(html):
-    snlm0e_patterns = [
-        r'"SNlM0e":"([^"]+)"',
-        r"'SNlM0e':'([^']+)'",
-        r'SNlM0e["\']?\s*[:=]\s*["\']([^"\']+)["\']',
-        r'"FdrFJe":"([^"]+)"',
-        r"'FdrFJe':'([^']+)'",
-        r'FdrFJe["\']?\s*[:=]\s*["\']([^"\']+)["\']',
-        r'"cfb2h":"([^"]+)"',
-        r"'cfb2h':'([^']+)'",
-        r'cfb2h["\']?\s*[:=]\s*["\']([^"\']+)["\']',
-        r'at["\']?\s*[:=]\s*["\']([^"\']{50,})["\']',
-        r'"at":"([^"]+)"',
-        r'"token":"([^"]+)"',
-        r'data-token["\']?\s*=\s*["\']([^"\']+)["\']',
+# SNlM0e patterns grouped by the key literal they require, in priority order.
+# A group is only searched when its key occurs in the HTML (in any case), so
+# keys that are absent cost a substring scan instead of a regex scan per pattern.
+_SNLM0E_PATTERNS = tuple(
+    (key, tuple(re.compile(p, re.IGNORECASE) for p in patterns))
+    for key, patterns in [
+        ('SNlM0e', [
+            r'"SNlM0e":"([^"]+)"',
+            r"'SNlM0e':'([^']+)'",
+            r'SNlM0e["\']?\s*[:=]\s*["\']([^"\']+)["\']',
+        ]),
+        ('FdrFJe', [
+            r'"FdrFJe":"([^"]+)"',
+            r"'FdrFJe':'([^']+)'",
+            r'FdrFJe["\']?\s*[:=]\s*["\']([^"\']+)["\']',
+        ]),
+        ('cfb2h', [
+            r'"cfb2h":"([^"]+)"',
+            r"'cfb2h':'([^']+)'",
+            r'cfb2h["\']?\s*[:=]\s*["\']([^"\']+)["\']',
+        ]),
+        ('at', [
+            r'at["\']?\s*[:=]\s*["\']([^"\']{50,})["\']',
+            r'"at":"([^"]+)"',
+        ]),
+        ('token', [
+            r'"token":"([^"]+)"',
+            r'data-token["\']?\s*=\s*["\']([^"\']+)["\']',
+        ]),
     ]
+)
+
+# Keys worth looking for in inline scripts; HTML without any of them skips the fallback
+_SCRIPT_TOKEN_KEYS = ('SNlM0e', 'FdrFJe', 'cfb2h')
+_SCRIPT_TOKEN_KEY_BYTES = tuple(key.encode() for key in _SCRIPT_TOKEN_KEYS)
+
+# Remaining patterns are compiled once at import time, in priority order
+
+# Inline scripts only: external (src=) and empty script tags never match
+_SCRIPT_PATTERN = re.compile(
+    rb'<script\b(?![^>]*\ssrc\s*=)[^>]*>(?!\s*</script>)(.*?)</script>',
+    re.IGNORECASE | re.DOTALL
+)
+
+_JSON_PATTERN = re.compile(rb'\{[^}]*(?:"[^"]*token[^"]*"|SNlM0e|FdrFJe)[^}]*\}', re.IGNORECASE)
+
+_BL_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in [
+    r'bl["\']?\s*[:=]\s*["\']([^"\']+)["\']',
+    r'"bl":"([^"]+)"',
+    r'buildLabel["\']?\s*[:=]\s*["\']([^"\']+)["\']',
+    r'boq[_-]assistant[^"\']*_(\d+\.\d+[^"\']*)',
+    r'/_/BardChatUi.*?bl=([^&"\']+)',
+])
+
+_FSID_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in [
+    r'f\.sid["\']?\s*[:=]\s*["\']?([^"\'&\s]+)',
+    r'"fsid":"([^"]+)"',
+    r'f\.sid=([^&"\']+)',
+    r'sessionId["\']?\s*[:=]\s*["\']([^"\']+)["\']',
+])
+
+_REQID_PATTERN = re.compile(r'_reqid["\']?\s*[:=]\s*["\']?(\d+)')
+
+_MEDIA_ID_PATTERN = re.compile(r'"media_id":"([^"]+)"')
+
+def extract_snlm0e_token(html):
+    lowered = None
     
-    for i, pattern in enumerate(snlm0e_patterns):
-        match = re.search(pattern, html, re.IGNORECASE)
-        if match:
-            token = match.group(1)
-            if len(token) > 20:
-                return token
+    for key, patterns in _SNLM0E_PATTERNS:
+        if key not in html:
+            if lowered is None:
+                lowered = html.lower()
+            if key.lower() not in lowered:
+                continue
+        
+        for pattern in patterns:
+            match = pattern.search(html)
+            if match:
+                token = match.group(1)
+                if len(token) > 20:
+                    return token
     
     return None
 
 def extract_from_script_tags(html):
-    soup = BeautifulSoup(html, 'html.parser')
-    script_tags = soup.find_all('script')
+    if not any(key in html for key in _SCRIPT_TOKEN_KEYS):
+        return None
     
-    for script in script_tags:
-        if script.string:
-            script_content = script.string
-            
-            if 'SNlM0e' in script_content or 'FdrFJe' in script_content:
-                token = extract_snlm0e_token(script_content)
-                if token:
-                    return token
-            
-            json_patterns = [
-                r'\{[^}]*"[^"]*token[^"]*"[^}]*\}',
-                r'\{[^}]*SNlM0e[^}]*\}',
-                r'\{[^}]*FdrFJe[^}]*\}'
-            ]
-            
-            for pattern in json_patterns:
-                matches = re.finditer(pattern, script_content, re.IGNORECASE)
-                for match in matches:
-                    try:
-                        json_str = match.group(0)
-                        json_obj = json.loads(json_str)
-                        
-                        for key, value in json_obj.items():
-                            if isinstance(value, str) and len(value) > 50:
-                                return value
-                    except:
-                        continue
+    # Script bodies are sliced straight out of the raw HTML; no DOM is built
+    for script_match in _SCRIPT_PATTERN.finditer(html.encode()):
+        script_content = script_match.group(1)
+        
+        if any(key in script_content for key in _SCRIPT_TOKEN_KEY_BYTES):
+            token = extract_snlm0e_token(script_content.decode('utf-8', 'replace'))
+            if token:
+                return token
+        
+        for match in _JSON_PATTERN.finditer(script_content):
+            try:
+                json_str = match.group(0)
+                json_obj = json.loads(json_str)
+                
+                for key, value in json_obj.items():
+                    if isinstance(value, str) and len(value) > 50:
+                        return value
+            except:
+                continue
     
     return None
 
 def extract_build_and_session_params(html):
     params = {}
     
-    bl_patterns = [
-        r'bl["\']?\s*[:=]\s*["\']([^"\']+)["\']',
-        r'"bl":"([^"]+)"',
-        r'buildLabel["\']?\s*[:=]\s*["\']([^"\']+)["\']',
-        r'boq[_-]assistant[^"\']*_(\d+\.\d+[^"\']*)',
-        r'/_/BardChatUi.*?bl=([^&"\']+)',
-    ]
-    
-    for pattern in bl_patterns:
-        match = re.search(pattern, html, re.IGNORECASE)
+    for pattern in _BL_PATTERNS:
+        match = pattern.search(html)
         if match:
             params['bl'] = match.group(1)
             break
     
-    fsid_patterns = [
-        r'f\.sid["\']?\s*[:=]\s*["\']?([^"\'&\s]+)',
-        r'"fsid":"([^"]+)"',
-        r'f\.sid=([^&"\']+)',
-        r'sessionId["\']?\s*[:=]\s*["\']([^"\']+)["\']',
-    ]
-    
-    for pattern in fsid_patterns:
-        match = re.search(pattern, html, re.IGNORECASE)
+    for pattern in _FSID_PATTERNS:
+        match = pattern.search(html)
         if match:
             params['fsid'] = match.group(1)
             break
     
-    reqid_match = re.search(r'_reqid["\']?\s*[:=]\s*["\']?(\d+)', html)
+    reqid_match = _REQID_PATTERN.search(html)
     if reqid_match:
         params['reqid'] = int(reqid_match.group(1))
     
@@ -118,15 +156,50 @@ def extract_build_and_session_params(html):
 CACHED_SESSION = None
 CACHE_EXPIRY = 0
 CACHE_DURATION = 600 # 10 minutes
+SESSION_LOCK = threading.Lock()
+SCRAPE_IN_FLIGHT = None # {'done': Event, 'result': ...} while a scrape runs
+
+# Shared connection pool. Every scraped session mounts it, so keep-alive
+# connections to Google outlive the session (and its cookies) that opened them
+HTTP_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=1)
 
 def scrape_fresh_session():
-    global CACHED_SESSION, CACHE_EXPIRY
+    global CACHED_SESSION, CACHE_EXPIRY, SCRAPE_IN_FLIGHT
     
-    # Return cached session if valid
-    if CACHED_SESSION and time.time() < CACHE_EXPIRY:
-        return CACHED_SESSION
+    # The lock only guards the cache, never the network call
+    with SESSION_LOCK:
+        # Return cached session if valid
+        if CACHED_SESSION and time.time() < CACHE_EXPIRY:
+            return CACHED_SESSION
+        
+        in_flight = SCRAPE_IN_FLIGHT
+        is_leader = in_flight is None
+        if is_leader:
+            in_flight = SCRAPE_IN_FLIGHT = {'done': threading.Event(), 'result': None}
+    
+    if not is_leader:
+        # Share the outcome of the scrape already running, failures included,
+        # instead of queueing up another one behind it
+        in_flight['done'].wait()
+        return in_flight['result']
+    
+    scraped_data = None
+    try:
+        scraped_data = scrape_session()
+    finally:
+        with SESSION_LOCK:
+            if scraped_data:
+                CACHED_SESSION = scraped_data
+                CACHE_EXPIRY = time.time() + CACHE_DURATION
+            SCRAPE_IN_FLIGHT = None
+        in_flight['result'] = scraped_data
+        in_flight['done'].set()
+    
+    return scraped_data
 
+def scrape_session():
     session = requests.Session()
+    session.mount('https://', HTTP_ADAPTER)
     
     url = 'https://gemini.google.com/app'
     headers = {
@@ -149,10 +222,6 @@ def scrape_fresh_session():
         response = session.get(url, headers=headers, timeout=30)
         html = response.text
         
-        cookies = {}
-        for cookie in session.cookies:
-            cookies[cookie.name] = cookie.value
-        
         snlm0e = extract_snlm0e_token(html)
         
         if not snlm0e:
@@ -164,152 +233,190 @@ def scrape_fresh_session():
         params = extract_build_and_session_params(html)
         
         scraped_data = {
+            # Carries the scraped cookies for the follow-up requests
             'session': session,
-            'cookies': cookies,
             'snlm0e': snlm0e,
             'bl': params['bl'],
             'fsid': params['fsid'],
-            'reqid': params['reqid'],
-            'html': html
+            # The web client bumps _reqid for every request made on a session
+            'reqids': itertools.count(params['reqid'], 100000)
         }
         
-        # Update cache
-        CACHED_SESSION = scraped_data
-        CACHE_EXPIRY = time.time() + CACHE_DURATION
-        
         return scraped_data
         
     except Exception as e:
         return None
 
+def invalidate_session(scraped):
+    global CACHED_SESSION
+    
+    # Only drop the cache if no other request has already replaced it
+    with SESSION_LOCK:
+        if CACHED_SESSION is scraped:
+            CACHED_SESSION = None
+
+# StreamGenerate payload skeleton, built once. Only the prompt, snlm0e,
+# session id and request uuid slots change per request (see build_f_req)
+PAYLOAD_TEMPLATE = [
+    None,  # prompt
+    ["en-US"],
+    ["", "", "", None, None, None, None, None, None, ""],
+    None,  # snlm0e
+    None,  # session id
+    None,
+    [0],
+    1,
+    None,
+    None,
+    1,
+    0,
+    None,
+    None,
+    None,
+    None,
+    None,
+    [[0]],
+    0,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    1,
+    None,
+    None,
+    [4],
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    [2],
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+    0,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,  # request uuid
+    None,
+    []
+]
+
+def build_f_req(prompt_part, snlm0e):
+    payload_data = PAYLOAD_TEMPLATE.copy()
+    payload_data[0] = prompt_part
+    payload_data[3] = snlm0e
+    
+    # One urandom read covers both ids; each keeps uuid4's version and
+    # variant bits without building a UUID object
+    raw = bytearray(os.urandom(32))
+    for offset in (0, 16):
+        raw[offset + 6] = raw[offset + 6] & 0x0F | 0x40
+        raw[offset + 8] = raw[offset + 8] & 0x3F | 0x80
+    request_hex = raw[16:].hex().upper()
+    payload_data[4] = raw[:16].hex()
+    payload_data[59] = f'{request_hex[:8]}-{request_hex[8:12]}-{request_hex[12:16]}-{request_hex[16:20]}-{request_hex[20:]}'
+    
+    # Dumping the string again yields the quoted, escaped literal f.req expects
+    try:
+        payload_str = orjson.dumps(payload_data).decode()
+        f_req = b'[null,' + orjson.dumps(payload_str) + b']'
+    except orjson.JSONEncodeError:
+        # orjson rejects lone surrogates (e.g. "\ud800" in a JSON prompt);
+        # json.dumps escapes them as \uXXXX instead
+        payload_str = json.dumps(payload_data, separators=(',', ':'))
+        f_req = f'[null,{json.dumps(payload_str)}]'.encode()
+    
+    # Pre-encoded form body (f.req=...&=), sent as-is instead of a dict
+    return b'f.req=' + quote_from_bytes(f_req, safe='').encode() + b'&='
+
 def build_payload(prompt, snlm0e):
-    escaped_prompt = prompt.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
-    
-    session_id = uuid.uuid4().hex
-    request_uuid = str(uuid.uuid4()).upper()
-    
-    payload_data = [
-        [escaped_prompt, 0, None, None, None, None, 0],
-        ["en-US"],
-        ["", "", "", None, None, None, None, None, None, ""],
-        snlm0e,
-        session_id,
-        None,
-        [0],
-        1,
-        None,
-        None,
-        1,
-        0,
-        None,
-        None,
-        None,
-        None,
-        None,
-        [[0]],
-        0,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        1,
-        None,
-        None,
-        [4],
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        [2],
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        0,
-        None,
-        None,
-        None,
-        None,
-        None,
-        request_uuid,
-        None,
-        []
-    ]
+    return build_f_req([prompt, 0, None, None, None, None, 0], snlm0e)
+
+def extract_response_text(line):
+    data = orjson.loads(line)
     
-    payload_str = json.dumps(payload_data, separators=(',', ':'))
-    escaped_payload = payload_str.replace('\\', '\\\\').replace('"', '\\"')
+    if not isinstance(data, list) or len(data) == 0:
+        return None
+    if data[0][0] != "wrb.fr" or len(data[0]) <= 2 or not data[0][2]:
+        return None
     
-    return {
-        'f.req': f'[null,"{escaped_payload}"]',
-        '': ''
-    }
+    parsed = orjson.loads(data[0][2])
+    
+    if not isinstance(parsed, list) or len(parsed) <= 4:
+        return None
+    
+    content_array = parsed[4]
+    if not isinstance(content_array, list) or len(content_array) == 0:
+        return None
+    
+    first_item = content_array[0]
+    if not isinstance(first_item, list) or len(first_item) <= 1:
+        return None
+    
+    response_id = first_item[0]
+    text_array = first_item[1]
+    
+    if isinstance(response_id, str) and response_id.startswith('rc_'):
+        if isinstance(text_array, list) and len(text_array) > 0:
+            text_content = text_array[0]
+            if isinstance(text_content, str) and text_content:
+                return text_content
+    
+    return None
 
-def parse_streaming_response(response_text):
-    lines = response_text.strip().split('\n')
-    full_text = ""
+def parse_streaming_response(lines):
+    # Each chunk repeats the text generated so far, so only two rc_ lines are
+    # kept while streaming and decoded once the stream ends: the newest, and
+    # the longest (by raw length) as the fallback when the newest has no text
+    newest_line = None
+    longest_line = None
     
     for line in lines:
-        if not line or line.startswith(')]}'):
+        if b'rc_' in line and not line.startswith(b')]}'):
+            newest_line = line
+            if longest_line is None or len(line) > len(longest_line):
+                longest_line = line
+    
+    full_text = None
+    
+    for line in (newest_line, longest_line):
+        if line is None:
             continue
-            
+        
         try:
-            if line.isdigit():
-                continue
-                
-            data = json.loads(line)
-            
-            if isinstance(data, list) and len(data) > 0:
-                if data[0][0] == "wrb.fr" and len(data[0]) > 2:
-                    inner_json = data[0][2]
-                    
-                    if inner_json:
-                        parsed = json.loads(inner_json)
-                        
-                        if isinstance(parsed, list) and len(parsed) > 4:
-                            content_array = parsed[4]
-                            
-                            if isinstance(content_array, list) and len(content_array) > 0:
-                                first_item = content_array[0]
-                                
-                                if isinstance(first_item, list) and len(first_item) > 0:
-                                    response_id = first_item[0]
-                                    
-                                    if isinstance(response_id, str) and response_id.startswith('rc_'):
-                                        if len(first_item) > 1 and isinstance(first_item[1], list):
-                                            text_array = first_item[1]
-                                            
-                                            if len(text_array) > 0:
-                                                text_content = text_array[0]
-                                                
-                                                if isinstance(text_content, str) and len(text_content) > len(full_text):
-                                                    full_text = text_content
+            full_text = extract_response_text(line)
         except Exception as e:
             continue
+        
+        if full_text:
+            break
     
     if full_text:
         full_text = full_text.replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
     
     return full_text if full_text else None
 
-import base64
-
 def upload_image(session, image_bytes, mime_type, snlm0e):
     upload_url = "https://content-push.googleapis.com/upload/photomkt/img/1.0/internal/default/media?content_type=" + mime_type + "&protocolVersion=2.0&authuser=0&uploadType=multipart"
     
@@ -356,7 +463,7 @@ def upload_image(session, image_bytes, mime_type, snlm0e):
         # NOTE: Without exact knowledge of the current Gemini Web upload response, this is highly speculative.
         # However, many Google services use the `media_id` from the Scotty response.
         if 'media_id' in upload_response.text:
-             match = re.search(r'"media_id":"([^"]+)"', upload_response.text)
+             match = _MEDIA_ID_PATTERN.search(upload_response.text)
              if match:
                  return match.group(1)
         
@@ -369,10 +476,6 @@ def build_payload_with_image(prompt, snlm0e, image_id):
     # This is a speculative payload structure for images
     # Based on standard Bard/Gemini web patterns observed in 2024
     
-    escaped_prompt = prompt.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
-    session_id = uuid.uuid4().hex
-    request_uuid = str(uuid.uuid4()).upper()
-    
     # Structure with image often adds a list at the end of the prompt array or a separate field
     # [ [prompt, 0, ...], ..., [ [["image_url_or_id", 1], "caption"] ] ]
     
@@ -381,86 +484,17 @@ def build_payload_with_image(prompt, snlm0e, image_id):
     
     # We will try to inject it into the prompt structure
     
-    # Standard: [escaped_prompt, 0, None, None, None, None, 0]
-    # With Image: [escaped_prompt, 0, None, None, None, None, 0, None, [[["<image_id>", 1], null]]]
-    
-    image_struct = f'[[["{image_id}", 1], null]]'
-    
-    payload_data = [
-        [escaped_prompt, 0, None, None, None, None, 0, None, json.loads(image_struct)],
-        ["en-US"],
-        ["", "", "", None, None, None, None, None, None, ""],
-        snlm0e,
-        session_id,
-        None,
-        [0],
-        1,
-        None,
-        None,
-        1,
-        0,
-        None,
-        None,
-        None,
-        None,
-        None,
-        [[0]],
-        0,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        1,
-        None,
-        None,
-        [4],
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        [2],
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        None,
-        0,
-        None,
-        None,
-        None,
-        None,
-        None,
-        request_uuid,
-        None,
-        []
-    ]
+    # Standard: [prompt, 0, None, None, None, None, 0]
+    # With Image: [prompt, 0, None, None, None, None, 0, None, [[["<image_id>", 1], null]]]
     
-    payload_str = json.dumps(payload_data, separators=(',', ':'))
-    escaped_payload = payload_str.replace('\\', '\\\\').replace('"', '\\"')
+    image_struct = [[[image_id, 1], None]]
     
-    return {
-        'f.req': f'[null,"{escaped_payload}"]',
-        '': ''
-    }
+    return build_f_req([prompt, 0, None, None, None, None, 0, None, image_struct], snlm0e)
 
-def chat_with_gemini(prompt, image_base64=None):
-    start_time = time.time()
+def chat_with_gemini(prompt, image_base64=None, image_bytes=None, mime_type=None, retry=True, start_time=None):
+    # A retry keeps the original start so response_time covers both attempts
+    if start_time is None:
+        start_time = time.time()
     
     scraped = scrape_fresh_session()
     
@@ -471,15 +505,17 @@ def chat_with_gemini(prompt, image_base64=None):
         }
     
     session = scraped['session']
-    cookies = scraped['cookies']
     snlm0e = scraped['snlm0e']
     bl = scraped['bl']
     fsid = scraped['fsid']
-    reqid = scraped['reqid']
+    reqid = next(scraped['reqids'])
     
     # Image Upload Handling
     image_id = None
-    if image_base64:
+    if image_base64 and not image_bytes:
+        # Only image requests pay for the base64 import
+        import base64
+        
         try:
             # Decode base64
             if "," in image_base64:
@@ -490,9 +526,14 @@ def chat_with_gemini(prompt, image_base64=None):
                 mime_type = "image/jpeg" # Default
                 
             image_bytes = base64.b64decode(encoded)
-            
+        except Exception as e:
+            print(f"Image processing failed: {e}")
+            image_bytes = None
+    
+    if image_bytes:
+        try:
             # Attempt upload (Experimental)
-            image_id = upload_image(session, image_bytes, mime_type, snlm0e)
+            image_id = upload_image(session, image_bytes, mime_type or "image/jpeg", snlm0e)
             
             if not image_id:
                 print("Image upload failed, falling back to text-only")
@@ -511,8 +552,6 @@ def chat_with_gemini(prompt, image_base64=None):
     else:
         payload = build_payload(prompt, snlm0e)
     
-    cookie_str = '; '.join([f"{k}={v}" for k, v in cookies.items()])
-    
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
         'Accept': '*/*',
@@ -527,26 +566,33 @@ def chat_with_gemini(prompt, image_base64=None):
         'sec-fetch-site': 'same-origin',
         'sec-fetch-mode': 'cors',
         'sec-fetch-dest': 'empty',
-        'referer': 'https://gemini.google.com/',
-        'Cookie': cookie_str
+        'referer': 'https://gemini.google.com/'
     }
     
-    global CACHED_SESSION
-    
     try:
-        response = session.post(url, data=payload, headers=headers, timeout=60)
+        # Stream the body so chunks are parsed as they arrive instead of
+        # buffering the whole response first
+        with session.post(url, data=payload, headers=headers, timeout=60, stream=True) as response:
+            status_code = response.status_code
+            if status_code == 200:
+                result = parse_streaming_response(response.iter_lines(chunk_size=8192))
         
-        if response.status_code != 200:
+        # Handled after the with block so the failed response's connection is
+        # back in the pool before any retry
+        if status_code != 200:
             # Invalidate cache on error (e.g. 401, 403, 429)
-            print(f"Gemini request failed: {response.status_code}. Invalidating session cache.")
-            CACHED_SESSION = None
+            print(f"Gemini request failed: {status_code}. Invalidating session cache.")
+            invalidate_session(scraped)
+            
+            # A stale cached session is the usual cause, so retry once on a fresh one
+            if retry:
+                return chat_with_gemini(prompt, image_bytes=image_bytes, mime_type=mime_type, retry=False, start_time=start_time)
+            
             return {
                 'success': False,
-                'error': f'HTTP {response.status_code}'
+                'error': f'HTTP {status_code}'
             }
         
-        result = parse_streaming_response(response.text)
-        
         end_time = time.time()
         response_time = round(end_time - start_time, 2)
         
@@ -556,7 +602,7 @@ def chat_with_gemini(prompt, image_base64=None):
                 'response': result,
                 'metadata': {
                     'response_time': f'{response_time}s',
-                    'timestamp': datetime.utcnow().isoformat() + 'Z',
+                    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
                     'model': 'gemini',
                     'character_count': len(result),
                     'word_count': len(result.split())
@@ -565,7 +611,7 @@ def chat_with_gemini(prompt, image_base64=None):
         else:
             # Empty response might mean session is stale
             print("Empty response from Gemini. Invalidating session cache.")
-            CACHED_SESSION = None
+            invalidate_session(scraped)
             return {
                 'success': False,
                 'error': 'No response received from Gemini'
@@ -574,7 +620,7 @@ def chat_with_gemini(prompt, image_base64=None):
     except requests.exceptions.RequestException as e:
         # Network error implies we might need a fresh session
         print(f"Request exception: {e}. Invalidating session cache.")
-        CACHED_SESSION = None
+        invalidate_session(scraped)
         return {
             'success': False,
             'error': str(e)
@@ -590,7 +636,21 @@ def options_api():
 
 @app.route('/api/ask', methods=['GET', 'POST'])
 def ask_gemini():
-    if request.method == 'POST':
+    image_bytes = None
+    mime_type = None
+    
+    if request.method == 'POST' and request.mimetype == 'multipart/form-data':
+        # Raw file upload, no base64 round trip
+        prompt = request.form.get('prompt')
+        image_base64 = None
+        image_file = request.files.get('image')
+        if image_file:
+            image_bytes = image_file.read()
+            mime_type = image_file.mimetype or None
+        else:
+            # Clients may still send the image as a base64 text field
+            image_base64 = request.form.get('image')
+    elif request.method == 'POST':
         data = request.get_json()
         prompt = data.get('prompt') if data else None
         image_base64 = data.get('image') if data else None
@@ -608,7 +668,7 @@ def ask_gemini():
                 'method': 'GET or POST',
                 'parameters': {
                     'prompt': 'Your question or message (required)',
-                    'image': 'Base64 encoded image string (optional)'
+                    'image': 'Base64 encoded image string, or an image file in a multipart/form-data POST (optional)'
                 },
                 'example': '/api/ask?prompt=Hello'
             }
@@ -627,7 +687,7 @@ def ask_gemini():
         response.headers.add('Access-Control-Allow-Origin', '*')
         return response
     
-    result = chat_with_gemini(prompt, image_base64)
+    result = chat_with_gemini(prompt, image_base64, image_bytes=image_bytes, mime_type=mime_type)
     
     result['api_dev'] = '@ISmartCoder'
     result['prompt'] = prompt